@@ -1,10 +1,34 @@
+import atexit
+import csv
+import io
 import os
+import queue
+import tempfile
+import threading
+import time
+from collections import defaultdict
 from datetime import date, datetime
-from io import BytesIO
 from functools import wraps
-
-import pandas as pd
-from flask import Flask, flash, redirect, render_template, request, send_file, session, url_for
+from urllib.parse import quote
+
+import xlsxwriter
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from flask import (
+    Flask,
+    Response,
+    abort,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    stream_with_context,
+    url_for,
+)
+from flask_caching import Cache
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -14,8 +38,22 @@ from flask_login import (
     logout_user,
 )
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import CheckConstraint, UniqueConstraint, extract, func
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import (
+    CheckConstraint,
+    UniqueConstraint,
+    bindparam,
+    column,
+    delete,
+    event,
+    extract,
+    func,
+    select,
+    text,
+    tuple_,
+)
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import load_only, raiseload, selectinload
+from werkzeug.security import check_password_hash
 
 # =====================
 # 基础配置
@@ -24,18 +62,58 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "attendance-dev-secret")
 app.config["WEBMASTER_USERNAME"] = os.getenv("WEBMASTER_USERNAME", "ygqian")
 app.config["WEBMASTER_PASSWORD"] = os.getenv("WEBMASTER_PASSWORD", "ygqian")
+# 操作日志默认随业务事务同步提交，保证不丢失；置 1 改由后台线程异步批量写入（进程被强杀时队列中的日志会丢失）
+app.config["AUDIT_LOG_ASYNC"] = os.getenv("AUDIT_LOG_ASYNC", "0") == "1"
+# 开发排查 N+1：置 1 时未显式预加载的关系一被访问就抛错，生产环境保持 0
+app.config["SQL_STRICT_LOADING"] = os.getenv("SQL_STRICT_LOADING", "0") == "1"
 
 # 默认使用 SQLite（支持通过 DATABASE_URL 覆盖），并统一放在 data 目录
 base_dir = os.path.abspath(os.path.dirname(__file__))
 default_db_path = os.path.join(base_dir, "data", "attendance.db")
 default_sqlite_url = f"sqlite:///{default_db_path.replace(os.sep, '/')}"
 app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", default_sqlite_url)
+# Excel 导出文件目录；配置 EXPORT_ACCEL_PREFIX（如 /_exports/）后改由 nginx 通过 X-Accel-Redirect 直接发送文件
+app.config["EXPORT_DIR"] = os.getenv("EXPORT_DIR", os.path.join(base_dir, "data", "exports"))
+app.config["EXPORT_ACCEL_PREFIX"] = os.getenv("EXPORT_ACCEL_PREFIX", "")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "connect_args": {"timeout": 30},
-}
+# 连接池：pre_ping 丢弃失效连接，recycle 避免数据库端超时断开的长连接被复用
+# query_cache_size：SQL 编译缓存条目数（默认 500），按语句形状缓存编译结果，调大以容纳全部热点语句变体
+engine_options = {"pool_pre_ping": True, "pool_recycle": 1800, "query_cache_size": 1200}
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+    # SQLite 只有一个写入者，连接池用 SQLAlchemy 默认值即可；timeout 为等待写锁的秒数
+    engine_options["connect_args"] = {"timeout": 30}
+else:
+    engine_options.update(pool_size=10, max_overflow=20)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
 
 db = SQLAlchemy(app)
+# 下拉列表等小表查询的短时缓存。生产用 gunicorn 多 worker，缓存放在各进程共享的文件目录中，
+# 任一 worker 清除缓存后其它 worker 立即可见
+app.config["CACHE_TYPE"] = "FileSystemCache"
+app.config["CACHE_DIR"] = os.getenv("CACHE_DIR", os.path.join(base_dir, "data", "cache"))
+app.config["CACHE_THRESHOLD"] = 2000
+app.config["CACHE_DEFAULT_TIMEOUT"] = 30
+cache = Cache(app)
+
+
+def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+    """SQLite 连接参数：WAL 让读写并发，synchronous=NORMAL 在 WAL 下减少每次提交的 fsync。"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    # 页缓存按连接生效，默认约 2MB；负数单位为 KiB，这里放大到约 20MB
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.url.drivername.startswith("sqlite"):
+        event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
+# 密码哈希使用 argon2id（C 实现，计算时释放 GIL），参数取 OWASP 推荐的最低配置
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
@@ -53,7 +131,13 @@ team_members = db.Table(
 class Company(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False, unique=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+
+    # 一对多集合可能很大且代码中不会遍历：lazy="raise" 让误用立即报错而不是悄悄产生 N+1；
+    # passive_deletes="all" 让删除父对象时不去加载/置空子记录，关联数据统一由 purge_* 批量删除
+    users = db.relationship("User", back_populates="company", lazy="raise", passive_deletes="all")
+    teams = db.relationship("Team", back_populates="company", lazy="raise", passive_deletes="all")
+    employees = db.relationship("Employee", back_populates="company", lazy="raise", passive_deletes="all")
 
 
 class User(UserMixin, db.Model):
@@ -63,17 +147,32 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     is_owner = db.Column(db.Boolean, default=False)
     is_admin = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
 
     __table_args__ = (UniqueConstraint("company_id", "username", name="uq_company_username"),)
 
-    company = db.relationship("Company", backref=db.backref("users", lazy=True))
+    company = db.relationship("Company", back_populates="users", lazy="select")
+    managed_teams = db.relationship("Team", back_populates="manager", lazy="raise", passive_deletes="all")
+    logs = db.relationship("AuditLog", back_populates="operator", lazy="raise", passive_deletes="all")
 
     def set_password(self, raw_password: str):
-        self.password_hash = generate_password_hash(raw_password)
+        self.password_hash = password_hasher.hash(raw_password)
 
     def check_password(self, raw_password: str) -> bool:
-        return check_password_hash(self.password_hash, raw_password)
+        """校验密码；旧版 werkzeug 哈希校验通过后自动升级为 argon2（需调用方提交）。"""
+        if not self.password_hash.startswith("$argon2"):
+            if not check_password_hash(self.password_hash, raw_password):
+                return False
+            self.set_password(raw_password)
+            return True
+
+        try:
+            password_hasher.verify(self.password_hash, raw_password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(raw_password)
+        return True
 
 
 class Team(db.Model):
@@ -81,12 +180,16 @@ class Team(db.Model):
     company_id = db.Column(db.Integer, db.ForeignKey("company.id"), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     manager_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
 
     __table_args__ = (UniqueConstraint("company_id", "name", name="uq_company_team_name"),)
 
-    company = db.relationship("Company", backref=db.backref("teams", lazy=True))
-    manager = db.relationship("User", backref=db.backref("managed_teams", lazy=True))
+    company = db.relationship("Company", back_populates="teams", lazy="select")
+    manager = db.relationship("User", back_populates="managed_teams", lazy="select")
+    # 成员按需在查询上用 selectinload 预加载，默认不随团队一起加载
+    members = db.relationship("Employee", secondary=team_members, back_populates="teams", lazy="select")
+    attendance_logs = db.relationship("Attendance", back_populates="team", lazy="raise", passive_deletes="all")
+    attendance_notes = db.relationship("AttendanceNote", back_populates="team", lazy="raise", passive_deletes="all")
 
 
 class Employee(db.Model):
@@ -98,12 +201,14 @@ class Employee(db.Model):
     bank_account = db.Column(db.String(64), nullable=False, default="")
     daily_salary = db.Column(db.Float, nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
 
     __table_args__ = (UniqueConstraint("company_id", "name", name="uq_company_employee_name"),)
 
-    teams = db.relationship("Team", secondary=team_members, backref="members")
-    company = db.relationship("Company", backref=db.backref("employees", lazy=True))
+    teams = db.relationship("Team", secondary=team_members, back_populates="members", lazy="select")
+    company = db.relationship("Company", back_populates="employees", lazy="select")
+    attendance_logs = db.relationship("Attendance", back_populates="employee", lazy="raise", passive_deletes="all")
+    advances = db.relationship("Advance", back_populates="employee", lazy="raise", passive_deletes="all")
 
 
 class Attendance(db.Model):
@@ -114,15 +219,18 @@ class Attendance(db.Model):
     work_date = db.Column(db.Date, nullable=False)
     day_count = db.Column(db.Float, nullable=False)
     created_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
 
     __table_args__ = (
         UniqueConstraint("employee_id", "team_id", "work_date", name="uq_attendance_employee_team_date"),
         CheckConstraint("day_count IN (0, 0.5, 1)", name="check_day_count"),
+        db.Index("ix_att_company_emp_date", "company_id", "employee_id", "work_date"),
+        db.Index("ix_att_company_date", "company_id", "work_date"),
+        db.Index("ix_att_emp_date", "employee_id", "work_date"),
     )
 
-    employee = db.relationship("Employee", backref=db.backref("attendance_logs", lazy=True))
-    team = db.relationship("Team", backref=db.backref("attendance_logs", lazy=True))
+    employee = db.relationship("Employee", back_populates="attendance_logs", lazy="select")
+    team = db.relationship("Team", back_populates="attendance_logs", lazy="select")
 
 
 class AttendanceNote(db.Model):
@@ -132,11 +240,11 @@ class AttendanceNote(db.Model):
     note_date = db.Column(db.Date, nullable=False)
     note = db.Column(db.String(500), default="")
     created_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
 
     __table_args__ = (UniqueConstraint("company_id", "team_id", "note_date", name="uq_attendance_note_team_date"),)
 
-    team = db.relationship("Team", backref=db.backref("attendance_notes", lazy=True))
+    team = db.relationship("Team", back_populates="attendance_notes", lazy="select")
 
 
 class Advance(db.Model):
@@ -147,9 +255,15 @@ class Advance(db.Model):
     advance_date = db.Column(db.Date, nullable=False)
     note = db.Column(db.String(255), default="")
     created_by = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+
+    __table_args__ = (
+        db.Index("ix_adv_company_emp_date", "company_id", "employee_id", "advance_date"),
+        db.Index("ix_adv_company_date", "company_id", "advance_date"),
+        db.Index("ix_adv_emp_date", "employee_id", "advance_date"),
+    )
 
-    employee = db.relationship("Employee", backref=db.backref("advances", lazy=True))
+    employee = db.relationship("Employee", back_populates="advances", lazy="select")
 
 
 class AuditLog(db.Model):
@@ -158,62 +272,667 @@ class AuditLog(db.Model):
     operator_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     action = db.Column(db.String(80), nullable=False)
     detail = db.Column(db.String(255), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+
+    # 审计表只追加写入，每个二级索引都会放大每次写入的成本：
+    # 只保留日志分页所需的 (company_id, created_at)，不要为 action/detail 等列随意加索引
+    __table_args__ = (db.Index("ix_audit_company_created", "company_id", "created_at"),)
+
+    operator = db.relationship("User", back_populates="logs", lazy="select")
+
+
+# 员工姓名全文索引：trigram 分词支持中文任意子串匹配，由触发器与 employee 表保持同步
+EMPLOYEE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE employee_fts USING fts5(name, content='employee', content_rowid='id', tokenize='trigram')",
+    """
+    CREATE TRIGGER IF NOT EXISTS employee_fts_ai AFTER INSERT ON employee BEGIN
+        INSERT INTO employee_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS employee_fts_ad AFTER DELETE ON employee BEGIN
+        INSERT INTO employee_fts(employee_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS employee_fts_au AFTER UPDATE OF name ON employee BEGIN
+        INSERT INTO employee_fts(employee_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        INSERT INTO employee_fts(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    "INSERT INTO employee_fts(employee_fts) VALUES ('rebuild')",
+]
+
+
+def init_db():
+    """建表并补齐索引。create_all 不会给已存在的表加索引，这里逐个按需创建，便于老库升级。"""
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    init_employee_fts()
+
+
+def init_employee_fts():
+    """SQLite 下创建员工姓名 FTS5 索引（已存在则跳过）；SQLite 版本过低不支持 trigram 时保持 LIKE 查询。"""
+    if db.engine.dialect.name != "sqlite":
+        return
+    try:
+        with db.engine.begin() as conn:
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'employee_fts'"))
+            if exists.first():
+                return
+            for statement in EMPLOYEE_FTS_DDL:
+                conn.execute(text(statement))
+    except OperationalError:
+        app.logger.warning("当前 SQLite 不支持 FTS5 trigram，员工搜索继续使用 LIKE")
+
+
+# 团队考勤写入：同一条语句内校验“其它团队当天合计 + 本次 <= 1”并插入或更新，
+# 避免先查询再写入的两次往返以及多个管理员同时录入时的竞态。
+# created_at 仍由程序显式传入：server_default 只对新建的库生效，SQLite 无法给老库已有列补默认值，
+# 省略该列会让老库写入 NULL 时间
+ATTENDANCE_UPSERT_SQL = text(
+    """
+    INSERT INTO attendance (company_id, employee_id, team_id, work_date, day_count, created_by, created_at)
+    SELECT :company_id, :employee_id, :team_id, :work_date, :day_count, :created_by, :created_at
+    WHERE (
+        SELECT COALESCE(SUM(day_count), 0) FROM attendance
+        WHERE employee_id = :employee_id AND work_date = :work_date AND team_id != :team_id
+    ) + :day_count <= 1
+    ON CONFLICT (employee_id, team_id, work_date)
+    DO UPDATE SET day_count = excluded.day_count, created_by = excluded.created_by
+    """
+).bindparams(bindparam("work_date", type_=db.Date), bindparam("created_at", type_=db.DateTime))
+
+# 批量导入考勤：只新增不覆盖，同样在语句内校验当天合计不超过 1 天；
+# 已存在的 (员工, 团队, 日期) 直接跳过，并发写入抢先时不会报唯一约束错误
+ATTENDANCE_INSERT_SQL = text(
+    """
+    INSERT INTO attendance (company_id, employee_id, team_id, work_date, day_count, created_by, created_at)
+    SELECT :company_id, :employee_id, :team_id, :work_date, :day_count, :created_by, :created_at
+    WHERE (
+        SELECT COALESCE(SUM(day_count), 0) FROM attendance
+        WHERE employee_id = :employee_id AND work_date = :work_date
+    ) + :day_count <= 1
+    ON CONFLICT (employee_id, team_id, work_date) DO NOTHING
+    """
+).bindparams(bindparam("work_date", type_=db.Date), bindparam("created_at", type_=db.DateTime))
+
+
+# 月度统计语句在导入时构建一次，调用时只传参数，省去每次拼装 Query 的开销
+MONTH_ATTENDANCE_SUMS_STMT = (
+    select(
+        Attendance.employee_id,
+        extract("year", Attendance.work_date),
+        extract("month", Attendance.work_date),
+        func.sum(Attendance.day_count),
+    )
+    .where(
+        Attendance.company_id == bindparam("company_id"),
+        Attendance.work_date >= bindparam("start"),
+        Attendance.work_date < bindparam("end"),
+    )
+    .group_by(
+        Attendance.employee_id,
+        extract("year", Attendance.work_date),
+        extract("month", Attendance.work_date),
+    )
+)
+MONTH_ADVANCE_SUMS_STMT = (
+    select(
+        Advance.employee_id,
+        extract("year", Advance.advance_date),
+        extract("month", Advance.advance_date),
+        func.sum(Advance.amount),
+    )
+    .where(
+        Advance.company_id == bindparam("company_id"),
+        Advance.advance_date >= bindparam("start"),
+        Advance.advance_date < bindparam("end"),
+    )
+    .group_by(
+        Advance.employee_id,
+        extract("year", Advance.advance_date),
+        extract("month", Advance.advance_date),
+    )
+)
+# 单个员工的月度统计：两个关联标量子查询分别求和（避免连接后行数相乘），连同日薪一条语句取回
+EMPLOYEE_MONTH_STAT_STMT = select(
+    select(func.coalesce(func.sum(Attendance.day_count), 0.0))
+    .where(
+        Attendance.employee_id == Employee.id,
+        Attendance.work_date >= bindparam("start"),
+        Attendance.work_date < bindparam("end"),
+    )
+    .scalar_subquery(),
+    select(func.coalesce(func.sum(Advance.amount), 0.0))
+    .where(
+        Advance.employee_id == Employee.id,
+        Advance.advance_date >= bindparam("start"),
+        Advance.advance_date < bindparam("end"),
+    )
+    .scalar_subquery(),
+    Employee.daily_salary,
+).where(Employee.id == bindparam("employee_id"))
+
+LOGIN_LOOKUP_STMT = (
+    select(Company.id, User)
+    .outerjoin(User, (User.company_id == Company.id) & (User.username == bindparam("username")))
+    .where(Company.name == bindparam("company_name"))
+)
 
-    operator = db.relationship("User", backref=db.backref("logs", lazy=True))
+# 列表查询语句同样在导入时构建，视图中只按需追加搜索条件并传入参数
+TEAM_LIST_STMT = (
+    select(
+        Team.id,
+        Team.name,
+        User.username.label("manager_name"),
+        func.count(team_members.c.employee_id).label("member_count"),
+    )
+    # 负责人账号可能已被删除（旧版删除账号时未转交团队），外连接保证这类团队仍能列出
+    .outerjoin(User, User.id == Team.manager_id)
+    .outerjoin(team_members, team_members.c.team_id == Team.id)
+    .where(Team.company_id == bindparam("company_id"))
+    .group_by(Team.id, Team.name, User.username)
+    .order_by(Team.created_at.desc())
+)
+TEAM_SEARCH_STMT = TEAM_LIST_STMT.where(Team.name.like(bindparam("name_pattern")))
+EMPLOYEE_LIST_STMT = (
+    select(Employee)
+    .where(Employee.company_id == bindparam("company_id"))
+    .order_by(Employee.created_at.desc())
+)
+PAYROLL_EMPLOYEES_STMT = select(Employee.id, Employee.name, Employee.daily_salary).where(
+    Employee.company_id == bindparam("company_id")
+)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # 每个请求都会执行，只取权限判断与页面展示需要的列，password_hash 等按需再加载
+    return db.session.get(
+        User,
+        int(user_id),
+        options=[load_only(User.id, User.company_id, User.username, User.is_owner, User.is_admin)],
+    )
 
 
 # =====================
 # 权限与公共函数
 # =====================
-def log_action(action: str, detail: str):
-    """记录操作日志，便于公司创建者审计。"""
-    item = AuditLog(
-        company_id=current_user.company_id,
-        operator_id=current_user.id,
-        action=action,
-        detail=detail,
-    )
-    db.session.add(item)
+_audit_queue = queue.Queue()
+_audit_worker_lock = threading.Lock()
+_audit_worker_pid = None
+AUDIT_WRITE_RETRIES = 3
+
+
+def _take_audit_batch(first_item=None, max_items: int = 500):
+    batch = [] if first_item is None else [first_item]
+    while len(batch) < max_items:
+        try:
+            batch.append(_audit_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _write_audit_batch(batch):
+    try:
+        for attempt in range(1, AUDIT_WRITE_RETRIES + 1):
+            try:
+                with app.app_context():
+                    db.session.bulk_insert_mappings(AuditLog, batch)
+                    db.session.commit()
+                return
+            except Exception:
+                # SQLite 写锁竞争等临时错误稍后重试，多次失败才放弃
+                if attempt == AUDIT_WRITE_RETRIES:
+                    app.logger.exception("操作日志批量写入失败（已重试 %s 次），丢弃 %s 条", attempt, len(batch))
+                else:
+                    time.sleep(attempt)
+    finally:
+        for _ in batch:
+            _audit_queue.task_done()
+
+
+def flush_audit_queue():
+    """同步写入队列中剩余的全部操作日志（进程退出时调用）。"""
+    while True:
+        batch = _take_audit_batch()
+        if not batch:
+            return
+        _write_audit_batch(batch)
+
+
+def _audit_worker():
+    while True:
+        # 阻塞等待第一条，再顺带取走已排队的其它日志一起写入
+        _write_audit_batch(_take_audit_batch(_audit_queue.get()))
+
+
+def _ensure_audit_worker():
+    """按进程懒启动后台写日志线程（gunicorn fork 后的 worker 需各自启动）。"""
+    global _audit_worker_pid
+    if _audit_worker_pid == os.getpid():
+        return
+    with _audit_worker_lock:
+        if _audit_worker_pid != os.getpid():
+            threading.Thread(target=_audit_worker, name="audit-log-writer", daemon=True).start()
+            _audit_worker_pid = os.getpid()
+
+
+atexit.register(flush_audit_queue)
+
+
+@event.listens_for(db.session, "before_commit")
+def _add_pending_audit_logs(session):
+    # 同步模式：本次事务累积的日志在提交前一次性加入会话，随业务数据在同一事务中批量写入
+    if app.config["AUDIT_LOG_ASYNC"]:
+        return
+    items = session.info.pop("pending_audit_logs", None)
+    if items:
+        session.add_all([AuditLog(**item) for item in items])
+
+
+@event.listens_for(db.session, "after_commit")
+def _enqueue_pending_audit_logs(session):
+    # 业务事务提交成功后才入队，回滚的操作不会留下日志
+    items = session.info.pop("pending_audit_logs", None)
+    if items:
+        _ensure_audit_worker()
+        for item in items:
+            _audit_queue.put(item)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_pending_audit_logs(session):
+    session.info.pop("pending_audit_logs", None)
 
 
-def ensure_company_scope(obj):
-    """确保所有数据操作都在当前公司范围内，防止跨公司访问。"""
-    if obj.company_id != current_user.company_id:
-        flash("无权访问该数据。", "danger")
-        return False
-    return True
+def log_action(action: str, detail: str):
+    """记录操作日志，便于公司创建者审计。
+
+    日志先暂存在会话中：默认在提交前一次性加入本次事务一起写入；
+    开启 AUDIT_LOG_ASYNC 时在提交后交给后台线程批量写入。事务回滚时暂存的日志一并丢弃。
+    """
+    item = {
+        "company_id": current_user.company_id,
+        "operator_id": current_user.id,
+        "action": action,
+        "detail": detail,
+        "created_at": datetime.utcnow(),
+    }
+    db.session.info.setdefault("pending_audit_logs", []).append(item)
+
+
+def scoped_get(model, obj_id: int):
+    """按主键读取当前公司的数据；不存在或属于其它公司一律 404，不泄露数据是否存在。
+
+    session.get 优先命中本次请求的 identity map，同一对象重复读取不会再查库。
+    """
+    obj = db.session.get(model, obj_id)
+    if obj is None or obj.company_id != current_user.company_id:
+        abort(404)
+    return obj
+
+
+@cache.memoize()
+def company_admin_choices(company_id: int):
+    """公司内管理员（团队负责人下拉）。返回普通字典，避免缓存脱离 session 的 ORM 对象。"""
+    rows = (
+        db.session.query(User.id, User.username)
+        .filter_by(company_id=company_id, is_admin=True)
+        .order_by(User.id.asc())
+        .all()
+    )
+    return [{"id": row.id, "username": row.username} for row in rows]
+
+
+@cache.memoize()
+def company_team_choices(company_id: int):
+    """公司内团队（按名称排序），用于表单选择。"""
+    rows = db.session.query(Team.id, Team.name).filter_by(company_id=company_id).order_by(Team.name.asc()).all()
+    return [{"id": row.id, "name": row.name} for row in rows]
+
+
+@cache.memoize()
+def company_employee_choices(company_id: int):
+    """公司内员工，用于表单选择。"""
+    rows = db.session.query(Employee.id, Employee.name).filter_by(company_id=company_id).order_by(Employee.id.asc()).all()
+    return [{"id": row.id, "name": row.name} for row in rows]
+
+
+def company_data_version(company_id: int) -> int:
+    """公司数据版本号，团队/员工/管理员变更时更新，用于列表页缓存的键。
+
+    版本号与列表缓存同在各 worker 共享的缓存中；文件缓存超量清理时版本号也可能被删，
+    此时生成新的版本号（而不是回落到 0），避免命中变更前按旧版本写入的缓存。
+    """
+    key = f"company_version:{company_id}"
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=0)
+        version = cache.get(key)
+    return version
+
+
+def cached_company_data(name: str, company_id: int, builder, *key_parts):
+    """按 (页面, 公司, 数据版本, 查询参数) 缓存列表页数据；数据变更后版本号改变，旧缓存自然失效。"""
+    key = ":".join(str(part) for part in (name, company_id, company_data_version(company_id), *key_parts))
+    data = cache.get(key)
+    if data is None:
+        data = builder()
+        cache.set(key, data)
+    return data
+
+
+def invalidate_company_choices(company_id: int):
+    """管理员、团队、员工发生增删改后清除对应公司的下拉缓存，并使列表页缓存失效。"""
+    cache.delete_memoized(company_admin_choices, company_id)
+    cache.delete_memoized(company_team_choices, company_id)
+    cache.delete_memoized(company_employee_choices, company_id)
+    cache.set(f"company_version:{company_id}", time.time_ns(), timeout=0)
+
+
+def request_year_month():
+    """读取请求参数中的年月；格式错误或超出范围（月 1-12、年 1970-2100）时提示并回退到当前月份。"""
+    today = date.today()
+    try:
+        year = int(request.args.get("year", today.year))
+        month = int(request.args.get("month", today.month))
+    except ValueError:
+        year = month = 0
+    if not (1 <= month <= 12 and 1970 <= year <= 2100):
+        flash("年月参数无效，已切换为当前月份。", "warning")
+        return today.year, today.month
+    return year, month
+
+
+def month_bounds(year: int, month: int):
+    """返回某月的起止日期 [start, end)，便于按日期区间过滤以命中索引。"""
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+def build_month_stat(days: float, advances: float, daily_salary: float):
+    """根据考勤天数、借支与日薪计算月度统计（天数、借支、应发、剩余）。"""
+    gross = round(days * daily_salary, 2)
+    remaining = round(gross - advances, 2)
+    return round(days, 2), round(advances, 2), gross, remaining
+
+
+def company_data_months(company_id: int):
+    """公司内出现过考勤或借支的全部年月 {(year, month)}，由数据库去重后只返回月份。"""
+    months = set()
+    for model, date_column in ((Attendance, Attendance.work_date), (Advance, Advance.advance_date)):
+        rows = db.session.execute(
+            select(extract("year", date_column), extract("month", date_column))
+            .where(model.company_id == company_id)
+            .distinct()
+        ).all()
+        months.update((int(y), int(m)) for y, m in rows)
+    return months
+
+
+def calculate_month_stats_bulk(company_id: int, months):
+    """一次性汇总公司内全部员工多个月份的考勤天数与借支。
+
+    每张表只执行一条按 (员工, 年, 月) 分组的查询，返回 {(year, month): {employee_id: (days, advances)}}。
+    """
+    ordered = sorted(months)
+    stats = {key: {} for key in ordered}
+    start, _ = month_bounds(*ordered[0])
+    _, end = month_bounds(*ordered[-1])
+    params = {"company_id": company_id, "start": start, "end": end}
+    att_rows = db.session.execute(MONTH_ATTENDANCE_SUMS_STMT, params).all()
+    adv_rows = db.session.execute(MONTH_ADVANCE_SUMS_STMT, params).all()
+
+    for employee_id, y, m, days in att_rows:
+        month_stats = stats.get((int(y), int(m)))
+        if month_stats is not None:
+            month_stats[employee_id] = (days or 0.0, 0.0)
+    for employee_id, y, m, amount in adv_rows:
+        month_stats = stats.get((int(y), int(m)))
+        if month_stats is not None:
+            days, _ = month_stats.get(employee_id, (0.0, 0.0))
+            month_stats[employee_id] = (days, amount or 0.0)
+    return stats
 
 
 def calculate_month_stat(employee_id: int, year: int, month: int):
     """计算某员工某月的工资统计。"""
-    att_q = (
-        db.session.query(func.coalesce(func.sum(Attendance.day_count), 0.0))
-        .filter(
-            Attendance.employee_id == employee_id,
-            extract("year", Attendance.work_date) == year,
-            extract("month", Attendance.work_date) == month,
+    start, end = month_bounds(year, month)
+    params = {"employee_id": employee_id, "start": start, "end": end}
+    days, advances, daily_salary = db.session.execute(EMPLOYEE_MONTH_STAT_STMT, params).one()
+    return build_month_stat(days, advances, daily_salary)
+
+
+_employee_fts_available = None
+
+
+def employee_fts_available() -> bool:
+    """当前数据库是否已建立 employee_fts（每个进程只检查一次）。"""
+    global _employee_fts_available
+    if _employee_fts_available is None:
+        _employee_fts_available = db.engine.dialect.name == "sqlite" and bool(
+            db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'employee_fts'")
+            ).first()
         )
-        .scalar()
+    return _employee_fts_available
+
+
+def filter_employee_name(query, keyword: str):
+    """按姓名关键字过滤员工。
+
+    关键字不少于 3 个字符且 FTS5 索引可用时走 trigram 索引匹配，
+    否则（短关键字、非 SQLite）回退到 LIKE 子串匹配。两者都是子串匹配，但大小写处理不同：
+    trigram 按 Unicode 规则忽略大小写（如 É/é），SQLite 的 LIKE 只忽略 ASCII 字母大小写；
+    中文姓名没有大小写，结果一致。
+    """
+    if len(keyword) >= 3 and employee_fts_available():
+        phrase = '"' + keyword.replace('"', '""') + '"'
+        matched_ids = text("SELECT rowid FROM employee_fts WHERE employee_fts MATCH :name_phrase").bindparams(
+            name_phrase=phrase
+        ).columns(column("rowid", db.Integer))
+        return query.filter(Employee.id.in_(matched_ids))
+    return query.filter(Employee.name.like(f"%{keyword}%"))
+
+
+def eager_options(*options):
+    """查询的关系加载选项；开启 SQL_STRICT_LOADING 时追加 raiseload("*")，漏写预加载的关系会直接报错。"""
+    if app.config["SQL_STRICT_LOADING"]:
+        return (*options, raiseload("*"))
+    return options
+
+
+def get_team_with_members(team_id: int, with_members: bool = True):
+    """加载当前公司的团队并用一条 IN 查询预取全部成员，避免遍历成员时逐个懒加载。
+
+    with_members=False 时只取团队本身，成员由调用方另行查询（如按姓名搜索）。
+    """
+    stmt = select(Team).where(Team.id == team_id, Team.company_id == current_user.company_id)
+    if with_members:
+        stmt = stmt.options(*eager_options(selectinload(Team.members)))
+    return db.one_or_404(stmt)
+
+
+def search_team_members(team_id: int, keyword: str):
+    """在数据库中按姓名筛选团队成员，只取回匹配的员工。"""
+    stmt = (
+        select(Employee)
+        .join(team_members, team_members.c.employee_id == Employee.id)
+        .where(team_members.c.team_id == team_id)
     )
-    employee = Employee.query.get(employee_id)
-    advances = (
-        db.session.query(func.coalesce(func.sum(Advance.amount), 0.0))
+    return db.session.execute(filter_employee_name(stmt, keyword)).scalars().all()
+
+
+def is_team_member(team_id: int, employee_id: int) -> bool:
+    """直接查询关联表判断员工是否在团队中，不加载 employee.teams 集合。"""
+    return (
+        db.session.execute(
+            select(1).where(team_members.c.team_id == team_id, team_members.c.employee_id == employee_id)
+        ).first()
+        is not None
+    )
+
+
+def add_team_member(team_id: int, employee_id: int):
+    """把员工加入团队（直接写关联表）。"""
+    db.session.execute(team_members.insert().values(team_id=team_id, employee_id=employee_id))
+
+
+def other_team_day_sums(team_id: int, work_date: date, employee_ids) -> dict:
+    """返回 {employee_id: 其它团队当天已记录天数}，一次分组查询完成。"""
+    if not employee_ids:
+        return {}
+    rows = (
+        db.session.query(Attendance.employee_id, func.sum(Attendance.day_count))
         .filter(
-            Advance.employee_id == employee_id,
-            extract("year", Advance.advance_date) == year,
-            extract("month", Advance.advance_date) == month,
+            Attendance.employee_id.in_(employee_ids),
+            Attendance.work_date == work_date,
+            Attendance.team_id != team_id,
         )
-        .scalar()
+        .group_by(Attendance.employee_id)
+        .all()
     )
-    gross = round(att_q * employee.daily_salary, 2)
-    remaining = round(gross - advances, 2)
-    return round(att_q, 2), round(advances, 2), gross, remaining
+    return {employee_id: float(total or 0) for employee_id, total in rows}
+
+
+def iter_payroll_export_rows(employees_data, ordered_months, month_stats):
+    """逐行生成工资导出数据：姓名、日薪、各月天数、总天数、总借支、总工资、剩余工资。"""
+    month_maps = [month_stats[key] for key in ordered_months]
+    for emp in employees_data:
+        total_days = 0.0
+        total_advances = 0.0
+        total_gross = 0.0
+        month_days = []
+        for stats in month_maps:
+            entry = stats.get(emp.id)
+            if entry is None:
+                # 该月无考勤也无借支，跳过计算（全部月份汇总时大多数格子如此）
+                month_days.append(0.0)
+                continue
+            days, advances_amt, gross, _remain = build_month_stat(entry[0], entry[1], emp.daily_salary)
+            month_days.append(days)
+            total_days += days
+            total_advances += advances_amt
+            total_gross += gross
+
+        yield (
+            emp.name,
+            emp.daily_salary,
+            *month_days,
+            round(total_days, 2),
+            round(total_advances, 2),
+            round(total_gross, 2),
+            round(total_gross - total_advances, 2),
+        )
+
+
+def build_note_matrix(notes):
+    """把备注按年月、日期归并，同一天多条以“；”连接；返回按年月排序的 [(year, month, {day: 文本})]。"""
+    buckets = defaultdict(lambda: defaultdict(list))
+    for n in notes:
+        buckets[(n.note_date.year, n.note_date.month)][n.note_date.day].append(f"{n.team.name}:{n.note or '（空备注）'}")
+    return [
+        (year, month, {d: "；".join(days.get(d, ())) for d in range(1, 32)})
+        for (year, month), days in sorted(buckets.items())
+    ]
+
+
+EXPORT_CLEANUP_INTERVAL = 300
+_last_export_cleanup = 0.0
+
+
+def cleanup_stale_exports(max_age_seconds: int = 3600):
+    """删除导出目录中超时的文件（X-Accel-Redirect 模式下文件由 nginx 发送，无法在响应结束时删除）。
+
+    每个进程最多每 EXPORT_CLEANUP_INTERVAL 秒扫描一次目录；文件可能同时被其它 worker
+    或下载结束时的回调删除，读取属性和删除失败都直接跳过。
+    """
+    global _last_export_cleanup
+    now = time.time()
+    if now - _last_export_cleanup < EXPORT_CLEANUP_INTERVAL:
+        return
+    _last_export_cleanup = now
+
+    expire_before = now - max_age_seconds
+    with os.scandir(app.config["EXPORT_DIR"]) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < expire_before:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+
+def write_excel_sheet(workbook, sheet_name: str, headers, rows, header_format, column_formats=None):
+    """按行顺序写入一个工作表，兼容 xlsxwriter 的 constant_memory 模式。"""
+    worksheet = workbook.add_worksheet(sheet_name)
+    for col, cell_format in (column_formats or {}).items():
+        worksheet.set_column(col, col, None, cell_format)
+    worksheet.write_row(0, 0, headers, header_format)
+    for row_idx, row in enumerate(rows, start=1):
+        worksheet.write_row(row_idx, 0, row)
+
+
+def keyset_page(query, sort_column, page_size: int, parse_value):
+    """按 (sort_column, id) 倒序做 keyset 分页，避免 OFFSET 随页数线性变慢。
+
+    请求参数 before/before_id 是上一页最后一条记录的游标；返回 (items, next_cursor)，
+    没有下一页时 next_cursor 为 None。
+    """
+    model = sort_column.class_
+    before = request.args.get("before", "")
+    before_id = request.args.get("before_id", type=int)
+    if before and before_id:
+        try:
+            query = query.filter(tuple_(sort_column, model.id) < (parse_value(before), before_id))
+        except ValueError:
+            pass
+
+    items = query.order_by(sort_column.desc(), model.id.desc()).limit(page_size + 1).all()
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = {"before": getattr(last, sort_column.key).isoformat(), "before_id": last.id}
+    return items, next_cursor
+
+
+def admin_required(message: str = "仅管理员可操作。"):
+    """公司管理员权限校验，需放在 login_required 之后。"""
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped(*args, **kwargs):
+            if not current_user.is_admin:
+                flash(message, "danger")
+                return redirect(url_for("dashboard"))
+            return view_func(*args, **kwargs)
+
+        return _wrapped
+
+    return decorator
+
+
+def owner_required(message: str):
+    """公司创建者权限校验，需放在 login_required 之后。"""
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def _wrapped(*args, **kwargs):
+            if not current_user.is_owner:
+                flash(message, "danger")
+                return redirect(url_for("dashboard"))
+            return view_func(*args, **kwargs)
+
+        return _wrapped
+
+    return decorator
 
 
 def site_admin_required(view_func):
@@ -229,10 +948,12 @@ def site_admin_required(view_func):
     return _wrapped
 
 
-def purge_employees(employee_ids: list[int]):
-    """彻底删除员工及其相关记录。"""
-    if not employee_ids:
-        return
+def purge_employees(employee_ids):
+    """彻底删除员工及其相关记录，由调用方统一提交。
+
+    employee_ids 可以是 ID 列表，也可以是 select(Employee.id) 子查询；
+    批量删除请传子查询，各条 DELETE 在数据库内筛选员工，不必先把 ID 查到 Python 里。
+    """
     Attendance.query.filter(Attendance.employee_id.in_(employee_ids)).delete(synchronize_session=False)
     Advance.query.filter(Advance.employee_id.in_(employee_ids)).delete(synchronize_session=False)
     db.session.execute(team_members.delete().where(team_members.c.employee_id.in_(employee_ids)))
@@ -240,21 +961,18 @@ def purge_employees(employee_ids: list[int]):
 
 
 def purge_company(company_id: int):
-    """删除公司及其下全部关联信息。"""
-    team_ids = [item.id for item in Team.query.filter_by(company_id=company_id).all()]
-    employee_ids = [item.id for item in Employee.query.filter_by(company_id=company_id).all()]
-
-    if team_ids:
-        AttendanceNote.query.filter(AttendanceNote.team_id.in_(team_ids)).delete(synchronize_session=False)
-    if employee_ids:
-        purge_employees(employee_ids)
-
-    AuditLog.query.filter_by(company_id=company_id).delete(synchronize_session=False)
-    Attendance.query.filter_by(company_id=company_id).delete(synchronize_session=False)
-    Advance.query.filter_by(company_id=company_id).delete(synchronize_session=False)
-    Team.query.filter_by(company_id=company_id).delete(synchronize_session=False)
-    User.query.filter_by(company_id=company_id).delete(synchronize_session=False)
-    Company.query.filter_by(id=company_id).delete(synchronize_session=False)
+    """删除公司及其下全部关联信息。
+
+    各业务表都带 company_id，直接按公司整表删除，不必先把团队、员工 ID 查到 Python 里；
+    只有成员关联表没有 company_id，用子查询限定到本公司员工。
+    """
+    company_employee_ids = select(Employee.id).where(Employee.company_id == company_id).scalar_subquery()
+    db.session.execute(team_members.delete().where(team_members.c.employee_id.in_(company_employee_ids)))
+    for model in (AttendanceNote, Attendance, Advance, AuditLog, Employee, Team, User):
+        db.session.execute(
+            delete(model).where(model.company_id == company_id).execution_options(synchronize_session=False)
+        )
+    db.session.execute(delete(Company).where(Company.id == company_id).execution_options(synchronize_session=False))
 
 
 def purge_user_data(user: User):
@@ -263,9 +981,15 @@ def purge_user_data(user: User):
         purge_company(user.company_id)
         return
 
-    employee_ids = [item.id for item in Employee.query.filter_by(created_by=user.id).all()]
-    if employee_ids:
-        purge_employees(employee_ids)
+    purge_employees(select(Employee.id).where(Employee.created_by == user.id).scalar_subquery())
+
+    # 该账号负责的团队转交给公司创建者，避免团队负责人指向已删除的账号；
+    # manager_id 不允许为空，公司缺少创建者账号（历史数据）时保持原值，团队列表中负责人显示为空
+    owner_id = db.session.execute(
+        select(User.id).where(User.company_id == user.company_id, User.is_owner.is_(True))
+    ).scalar()
+    if owner_id is not None:
+        Team.query.filter_by(manager_id=user.id).update({"manager_id": owner_id}, synchronize_session=False)
 
     Attendance.query.filter_by(created_by=user.id).delete(synchronize_session=False)
     AttendanceNote.query.filter_by(created_by=user.id).delete(synchronize_session=False)
@@ -291,13 +1015,15 @@ def register():
         username = request.form["username"].strip()
         password = request.form["password"].strip()
 
-        if Company.query.filter_by(name=company_name).first():
-            flash("公司名已存在。", "danger")
-            return redirect(url_for("register"))
-
+        # 依赖公司名唯一约束判重，省去先查询再插入，也避免并发注册同名公司
         company = Company(name=company_name)
         db.session.add(company)
-        db.session.flush()
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            flash("公司名已存在。", "danger")
+            return redirect(url_for("register"))
 
         owner = User(company_id=company.id, username=username, is_owner=True, is_admin=True)
         owner.set_password(password)
@@ -317,16 +1043,19 @@ def login():
         username = request.form["username"].strip()
         password = request.form["password"].strip()
 
-        company = Company.query.filter_by(name=company_name).first()
-        if not company:
+        # 公司与账号一次查出：外连接下公司不存在时无行，账号不存在时 user 为 None
+        row = db.session.execute(LOGIN_LOOKUP_STMT, {"company_name": company_name, "username": username}).first()
+        if row is None:
             flash("公司不存在。", "danger")
             return redirect(url_for("login"))
 
-        user = User.query.filter_by(company_id=company.id, username=username).first()
+        user = row.User
         if not user or not user.check_password(password):
             flash("账号或密码错误。", "danger")
             return redirect(url_for("login"))
 
+        # 旧密码哈希在校验时可能被升级，需要一并保存
+        db.session.commit()
         login_user(user)
         flash("登录成功。", "success")
         return redirect(url_for("dashboard"))
@@ -364,8 +1093,23 @@ def site_admin_users():
     users_query = db.session.query(User, Company).join(Company, User.company_id == Company.id)
     if query_text:
         users_query = users_query.filter(User.username.like(f"%{query_text}%"))
-    rows = users_query.order_by(Company.created_at.desc(), User.created_at.asc()).all()
-    return render_template("site_admin_users.html", rows=rows, query_text=query_text)
+    # 按公司分组展示，排序键不唯一递增，这里用页码分页；多取一条用于判断是否还有下一页
+    page = max(request.args.get("page", 1, type=int), 1)
+    page_size = 50
+    rows = (
+        users_query.order_by(Company.created_at.desc(), Company.id.desc(), User.created_at.asc(), User.id.asc())
+        .offset((page - 1) * page_size)
+        .limit(page_size + 1)
+        .all()
+    )
+    has_next = len(rows) > page_size
+    return render_template(
+        "site_admin_users.html",
+        rows=rows[:page_size],
+        query_text=query_text,
+        page=page,
+        has_next=has_next,
+    )
 
 
 @app.route("/site-admin/users/<int:user_id>/update", methods=["POST"])
@@ -375,19 +1119,19 @@ def site_admin_user_update(user_id):
     username = request.form["username"].strip()
     password = request.form.get("password", "").strip()
 
-    duplicate = User.query.filter(
-        User.company_id == user.company_id,
-        User.username == username,
-        User.id != user.id,
-    ).first()
-    if duplicate:
+    # 由 (company_id, username) 唯一约束判重
+    user.username = username
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
         flash("同公司下用户名已存在。", "danger")
         return redirect(url_for("site_admin_users"))
 
-    user.username = username
     if password:
         user.set_password(password)
     db.session.commit()
+    invalidate_company_choices(user.company_id)
     flash("账号信息更新成功。", "success")
     return redirect(url_for("site_admin_users"))
 
@@ -396,8 +1140,10 @@ def site_admin_user_update(user_id):
 @site_admin_required
 def site_admin_user_delete(user_id):
     user = User.query.get_or_404(user_id)
+    company_id = user.company_id
     purge_user_data(user)
     db.session.commit()
+    invalidate_company_choices(company_id)
     flash("账号及关联数据已删除。", "success")
     return redirect(url_for("site_admin_users"))
 
@@ -416,25 +1162,25 @@ def logout():
 @app.route("/dashboard")
 @login_required
 def dashboard():
-    teams = Team.query.filter_by(company_id=current_user.company_id).all()
-    employees = Employee.query.filter_by(company_id=current_user.company_id).all()
-    return render_template("dashboard.html", teams=teams, employees=employees)
+    company_id = current_user.company_id
+    teams_count, employees_count = cached_company_data(
+        "dashboard",
+        company_id,
+        lambda: (
+            db.session.query(func.count(Team.id)).filter_by(company_id=company_id).scalar(),
+            db.session.query(func.count(Employee.id)).filter_by(company_id=company_id).scalar(),
+        ),
+    )
+    return render_template("dashboard.html", teams_count=teams_count, employees_count=employees_count)
 
 
 @app.route("/admins", methods=["GET", "POST"])
 @login_required
+@owner_required("只有公司创建者可以管理管理员。")
 def admins():
-    if not current_user.is_owner:
-        flash("只有公司创建者可以管理管理员。", "danger")
-        return redirect(url_for("dashboard"))
-
     if request.method == "POST":
         username = request.form["username"].strip()
         password = request.form["password"].strip()
-        if User.query.filter_by(company_id=current_user.company_id, username=username).first():
-            flash("用户名已存在。", "danger")
-            return redirect(url_for("admins"))
-
         admin = User(
             company_id=current_user.company_id,
             username=username,
@@ -443,8 +1189,16 @@ def admins():
         )
         admin.set_password(password)
         db.session.add(admin)
+        # 由 (company_id, username) 唯一约束判重
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            flash("用户名已存在。", "danger")
+            return redirect(url_for("admins"))
         log_action("create_admin", f"新增管理员：{username}")
         db.session.commit()
+        invalidate_company_choices(current_user.company_id)
         flash("管理员创建成功。", "success")
         return redirect(url_for("admins"))
 
@@ -454,11 +1208,8 @@ def admins():
 
 @app.route("/admins/<int:user_id>/delete", methods=["POST"])
 @login_required
+@owner_required("只有公司创建者可以删除管理员。")
 def admin_delete(user_id):
-    if not current_user.is_owner:
-        flash("只有公司创建者可以删除管理员。", "danger")
-        return redirect(url_for("dashboard"))
-
     target = User.query.get_or_404(user_id)
     if target.company_id != current_user.company_id or not target.is_admin:
         flash("无权删除该账号。", "danger")
@@ -468,10 +1219,12 @@ def admin_delete(user_id):
         flash("不能删除公司创建者账号。", "warning")
         return redirect(url_for("admins"))
 
-    # 删除该管理员创建的关联数据后再删除账号
-    employee_ids = [item.id for item in Employee.query.filter_by(company_id=current_user.company_id, created_by=target.id).all()]
-    if employee_ids:
-        purge_employees(employee_ids)
+    # 删除该管理员创建的关联数据后再删除账号；员工以子查询传入，由数据库直接筛选
+    purge_employees(
+        select(Employee.id)
+        .where(Employee.company_id == current_user.company_id, Employee.created_by == target.id)
+        .scalar_subquery()
+    )
 
     Attendance.query.filter_by(company_id=current_user.company_id, created_by=target.id).delete(synchronize_session=False)
     AttendanceNote.query.filter_by(company_id=current_user.company_id, created_by=target.id).delete(synchronize_session=False)
@@ -483,19 +1236,16 @@ def admin_delete(user_id):
     db.session.delete(target)
     log_action("delete_admin", f"删除管理员：{target.username}")
     db.session.commit()
+    invalidate_company_choices(current_user.company_id)
     flash("管理员及其关联数据已删除。", "success")
     return redirect(url_for("admins"))
 
 
 @app.route("/teams", methods=["GET", "POST"])
 @login_required
+@admin_required()
 def teams():
-    if not current_user.is_admin:
-        flash("仅管理员可操作。", "danger")
-        return redirect(url_for("dashboard"))
-
     query_text = request.args.get("q", "").strip()
-    admins_data = User.query.filter_by(company_id=current_user.company_id, is_admin=True).all()
 
     if request.method == "POST":
         name = request.form["name"].strip()
@@ -507,30 +1257,34 @@ def teams():
         db.session.add(team)
         log_action("create_team", f"新增团队：{name}")
         db.session.commit()
+        invalidate_company_choices(current_user.company_id)
         flash("团队创建成功。", "success")
         return redirect(url_for("teams"))
 
-    team_query = Team.query.filter_by(company_id=current_user.company_id)
-    if query_text:
-        team_query = team_query.filter(Team.name.like(f"%{query_text}%"))
-    items = team_query.order_by(Team.created_at.desc()).all()
+    # 一条分组查询取出团队、负责人和成员数，不再逐个团队懒加载负责人与成员列表
+    def load_teams():
+        params = {"company_id": current_user.company_id}
+        if query_text:
+            params["name_pattern"] = f"%{query_text}%"
+            rows = db.session.execute(TEAM_SEARCH_STMT, params).all()
+        else:
+            rows = db.session.execute(TEAM_LIST_STMT, params).all()
+        return [row._asdict() for row in rows]
+
+    items = cached_company_data("teams", current_user.company_id, load_teams, query_text)
+    admins_data = company_admin_choices(current_user.company_id)
     return render_template("teams.html", items=items, admins=admins_data, query_text=query_text)
 
 
 @app.route("/teams/<int:team_id>", methods=["GET", "POST"])
 @login_required
+@admin_required()
 def team_detail(team_id):
     """团队详情页：可在团队内直接新增员工，或把原有员工加入团队。"""
-    if not current_user.is_admin:
-        flash("仅管理员可操作。", "danger")
-        return redirect(url_for("dashboard"))
-
-    team = Team.query.get_or_404(team_id)
-    if not ensure_company_scope(team):
-        return redirect(url_for("teams"))
-
     query_text = request.args.get("q", "").strip()
     existing_q = request.args.get("existing_q", "").strip()
+    # 只有未搜索的列表页需要全部成员；POST 分支不读取 team.members，按姓名搜索时只查匹配的成员
+    team = get_team_with_members(team_id, with_members=request.method == "GET" and not query_text)
 
     if request.method == "POST":
         add_mode = request.form.get("add_mode", "new_employee")
@@ -540,15 +1294,14 @@ def team_detail(team_id):
             if not employee_id:
                 flash("请选择要加入团队的员工。", "warning")
                 return redirect(url_for("team_detail", team_id=team.id))
-            employee = Employee.query.get_or_404(int(employee_id))
-            if not ensure_company_scope(employee):
-                return redirect(url_for("teams"))
-            if team in employee.teams:
+            employee = scoped_get(Employee, int(employee_id))
+            if is_team_member(team.id, employee.id):
                 flash("该员工已在当前团队中。", "info")
                 return redirect(url_for("team_detail", team_id=team.id))
-            employee.teams.append(team)
+            add_team_member(team.id, employee.id)
             log_action("add_existing_employee_to_team", f"员工 {employee.name} 加入团队 {team.name}")
             db.session.commit()
+            invalidate_company_choices(current_user.company_id)
             flash("已成功将原有员工加入当前团队。", "success")
             return redirect(url_for("team_detail", team_id=team.id))
 
@@ -576,22 +1329,24 @@ def team_detail(team_id):
             db.session.add(employee)
             log_action("create_employee_in_team", f"团队 {team.name} 新增员工：{name}")
             db.session.commit()
+            invalidate_company_choices(current_user.company_id)
             flash("员工新增成功，并已加入当前团队。", "success")
             return redirect(url_for("team_detail", team_id=team.id))
 
         flash("未知的新增模式。", "danger")
         return redirect(url_for("team_detail", team_id=team.id))
 
-    members = team.members
-    if query_text:
-        members = [m for m in members if query_text.lower() in m.name.lower()]
+    members = search_team_members(team.id, query_text) if query_text else team.members
 
     # “原有员工”这里展示公司内全部员工（含已在本团队的员工），
     # 若重复添加会在提交时提示“已在当前团队中”。
-    available_query = Employee.query.filter(Employee.company_id == current_user.company_id)
+    # 未搜索时直接复用公司员工下拉缓存，不再每次查询
     if existing_q:
-        available_query = available_query.filter(Employee.name.like(f"%{existing_q}%"))
-    available_employees = available_query.order_by(Employee.name.asc()).all()
+        available_query = Employee.query.filter(Employee.company_id == current_user.company_id)
+        available_query = filter_employee_name(available_query, existing_q)
+        available_employees = available_query.order_by(Employee.name.asc()).all()
+    else:
+        available_employees = sorted(company_employee_choices(current_user.company_id), key=lambda e: e["name"])
 
     return render_template(
         "team_detail.html",
@@ -605,79 +1360,77 @@ def team_detail(team_id):
 
 @app.route("/teams/<int:team_id>/employees/<int:employee_id>/update", methods=["POST"])
 @login_required
+@admin_required()
 def team_employee_update(team_id, employee_id):
-    if not current_user.is_admin:
-        flash("仅管理员可操作。", "danger")
-        return redirect(url_for("dashboard"))
-
-    team = Team.query.get_or_404(team_id)
-    employee = Employee.query.get_or_404(employee_id)
-    if not ensure_company_scope(team) or not ensure_company_scope(employee):
-        return redirect(url_for("teams"))
-
-    new_name = request.form["name"].strip()
-    duplicated = Employee.query.filter(
-        Employee.company_id == current_user.company_id,
-        Employee.name == new_name,
-        Employee.id != employee.id,
-    ).first()
-    if duplicated:
-        flash("员工姓名已存在，不允许重复。", "danger")
-        return redirect(url_for("team_detail", team_id=team.id))
+    team = scoped_get(Team, team_id)
+    employee = scoped_get(Employee, employee_id)
 
-    employee.name = new_name
+    # 由 (company_id, name) 唯一约束判重，省去先查询同名员工
+    employee.name = request.form["name"].strip()
     employee.daily_salary = float(request.form["daily_salary"])
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        flash("员工姓名已存在，不允许重复。", "danger")
+        return redirect(url_for("team_detail", team_id=team_id))
 
-    if team not in employee.teams:
-        employee.teams.append(team)
+    if not is_team_member(team.id, employee.id):
+        add_team_member(team.id, employee.id)
 
     log_action("update_employee", f"更新员工：{employee.name}（团队 {team.name}）")
     db.session.commit()
+    invalidate_company_choices(current_user.company_id)
     flash("员工信息更新成功。", "success")
     return redirect(url_for("team_detail", team_id=team.id))
 
 
 @app.route("/teams/<int:team_id>/employees/<int:employee_id>/delete", methods=["POST"])
 @login_required
+@admin_required()
 def team_employee_delete(team_id, employee_id):
     """从团队移除员工；若该员工不在任何团队中则删除员工主档。"""
-    if not current_user.is_admin:
-        flash("仅管理员可操作。", "danger")
-        return redirect(url_for("dashboard"))
-
-    team = Team.query.get_or_404(team_id)
-    employee = Employee.query.get_or_404(employee_id)
-    if not ensure_company_scope(team) or not ensure_company_scope(employee):
-        return redirect(url_for("teams"))
-
-    if team in employee.teams:
-        employee.teams.remove(team)
+    team = scoped_get(Team, team_id)
+    employee = scoped_get(Employee, employee_id)
 
-    # 如果员工已不属于任何团队，可按业务需要直接删除
-    if len(employee.teams) == 0:
-        db.session.delete(employee)
+    db.session.execute(
+        team_members.delete().where(team_members.c.team_id == team.id, team_members.c.employee_id == employee.id)
+    )
+    remaining_teams = db.session.execute(
+        select(func.count()).select_from(team_members).where(team_members.c.employee_id == employee.id)
+    ).scalar()
+
+    # 员工已不属于任何团队时删除员工主档；已有考勤或借支记录的不删除，避免误删工资相关历史
+    if remaining_teams == 0:
+        has_history = db.session.execute(
+            select(
+                select(Attendance.id).where(Attendance.employee_id == employee.id).exists()
+                | select(Advance.id).where(Advance.employee_id == employee.id).exists()
+            )
+        ).scalar()
+        if has_history:
+            db.session.rollback()
+            flash("该员工已有考勤或借支记录，不能从其最后一个团队中移除。", "warning")
+            return redirect(url_for("team_detail", team_id=team_id))
+        purge_employees([employee.id])
         log_action("delete_employee", f"删除员工：{employee.name}")
     else:
         log_action("remove_employee_from_team", f"员工 {employee.name} 从团队 {team.name} 移除")
 
     db.session.commit()
+    invalidate_company_choices(current_user.company_id)
     flash("员工维护操作已完成。", "success")
     return redirect(url_for("team_detail", team_id=team.id))
 
 
 @app.route("/teams/<int:team_id>/attendance", methods=["GET", "POST"])
 @login_required
+@admin_required()
 def team_attendance(team_id):
     """团队考勤页：显示该团队全部员工，单选按钮录入考勤。"""
-    if not current_user.is_admin:
-        flash("仅管理员可操作。", "danger")
-        return redirect(url_for("dashboard"))
-
-    team = Team.query.get_or_404(team_id)
-    if not ensure_company_scope(team):
-        return redirect(url_for("teams"))
-
     query_text = request.args.get("q", "").strip()
+    # 提交考勤需要全部成员；按姓名搜索查看时只查匹配的成员
+    team = get_team_with_members(team_id, with_members=request.method == "POST" or not query_text)
 
     if request.method == "POST":
         work_date = datetime.strptime(request.form["work_date"], "%Y-%m-%d").date()
@@ -686,46 +1439,43 @@ def team_attendance(team_id):
             flash("不能记录未来日期的考勤。", "danger")
             return redirect(url_for("team_attendance", team_id=team.id, work_date=work_date.isoformat(), q=query_text))
 
-        error_messages = []
-        updated_count = 0
-        # 遍历团队下所有员工，批量写入当天考勤
+        submitted = {}
         for emp in team.members:
             raw_value = request.form.get(f"attendance_{emp.id}")
-            if raw_value is None:
-                continue
-
-            day_count = float(raw_value)
-            record = Attendance.query.filter_by(employee_id=emp.id, team_id=team.id, work_date=work_date).first()
+            if raw_value is not None:
+                submitted[emp] = float(raw_value)
 
-            # 计算该员工在其它团队的当天工时，保证总和不超过 1
-            other_sum = (
-                db.session.query(func.coalesce(func.sum(Attendance.day_count), 0.0))
-                .filter(
-                    Attendance.employee_id == emp.id,
-                    Attendance.work_date == work_date,
-                    Attendance.team_id != team.id,
-                )
-                .scalar()
-            )
-
-            if other_sum + day_count > 1.0:
-                error_messages.append(f"{emp.name} 超过1天（其它团队已记录 {other_sum} 天）")
+        # 一次分组查询取出所有员工在其它团队当天已记录的天数，先在 Python 中校验
+        other_sums = other_team_day_sums(team.id, work_date, [emp.id for emp in submitted])
+        error_messages = []
+        valid_rows = []
+        for emp, day_count in submitted.items():
+            if other_sums.get(emp.id, 0.0) + day_count > 1:
+                error_messages.append(f"{emp.name} 超过1天（其它团队已记录 {other_sums.get(emp.id, 0.0)} 天）")
                 continue
+            valid_rows.append(
+                {
+                    "company_id": current_user.company_id,
+                    "employee_id": emp.id,
+                    "team_id": team.id,
+                    "work_date": work_date,
+                    "day_count": day_count,
+                    "created_by": current_user.id,
+                    "created_at": datetime.utcnow(),
+                }
+            )
 
-            if record:
-                record.day_count = day_count
-                record.created_by = current_user.id
-            else:
-                record = Attendance(
-                    company_id=current_user.company_id,
-                    employee_id=emp.id,
-                    team_id=team.id,
-                    work_date=work_date,
-                    day_count=day_count,
-                    created_by=current_user.id,
-                )
-                db.session.add(record)
-            updated_count += 1
+        # 合规记录用一次 executemany 写入；语句自带的上限条件仍防并发写入超限
+        updated_count = 0
+        if valid_rows:
+            updated_count = db.session.execute(ATTENDANCE_UPSERT_SQL, valid_rows).rowcount
+            if updated_count < len(valid_rows):
+                # 校验后被并发写入抢先，重新统计找出未写入的员工用于提示
+                valid_ids = {row["employee_id"] for row in valid_rows}
+                other_sums = other_team_day_sums(team.id, work_date, list(valid_ids))
+                for emp, day_count in submitted.items():
+                    if emp.id in valid_ids and other_sums.get(emp.id, 0.0) + day_count > 1:
+                        error_messages.append(f"{emp.name} 超过1天（其它团队已记录 {other_sums.get(emp.id, 0.0)} 天）")
 
         # 保存当日团队整体备注（允许为空）
         note_obj = AttendanceNote.query.filter_by(
@@ -761,9 +1511,7 @@ def team_attendance(team_id):
 
         return redirect(url_for("team_attendance", team_id=team.id, work_date=work_date.isoformat(), q=query_text))
 
-    members = team.members
-    if query_text:
-        members = [m for m in members if query_text.lower() in m.name.lower()]
+    members = search_team_members(team.id, query_text) if query_text else team.members
 
     selected_date_str = request.args.get("work_date", date.today().isoformat())
     selected_date = datetime.strptime(selected_date_str, "%Y-%m-%d").date()
@@ -772,10 +1520,16 @@ def team_attendance(team_id):
         selected_date_str = selected_date.isoformat()
         flash("考勤日期不能超过今天，已自动切换为今天。", "warning")
 
-    attendance_map = {}
-    for emp in members:
-        record = Attendance.query.filter_by(employee_id=emp.id, team_id=team.id, work_date=selected_date).first()
-        attendance_map[emp.id] = record.day_count if record else 0
+    # 一次 IN 查询取出当天全部成员的考勤，未记录的默认 0
+    rows = db.session.execute(
+        select(Attendance.employee_id, Attendance.day_count).where(
+            Attendance.team_id == team.id,
+            Attendance.work_date == selected_date,
+            Attendance.employee_id.in_([emp.id for emp in members]),
+        )
+    ).all()
+    attendance_map = {emp.id: 0 for emp in members}
+    attendance_map.update(rows)
 
     note_obj = AttendanceNote.query.filter_by(
         company_id=current_user.company_id,
@@ -798,12 +1552,9 @@ def team_attendance(team_id):
 
 @app.route("/employees", methods=["GET", "POST"])
 @login_required
+@admin_required()
 def employees():
     """全局员工查询页（保留快速搜索能力）。"""
-    if not current_user.is_admin:
-        flash("仅管理员可操作。", "danger")
-        return redirect(url_for("dashboard"))
-
     if request.method == "POST":
         team_ids = [int(item) for item in request.form.getlist("team_ids") if item.isdigit()]
         employee_ids = [int(item) for item in request.form.getlist("employee_ids") if item.isdigit()]
@@ -837,51 +1588,59 @@ def employees():
         return redirect(url_for("employees"))
 
     query_text = request.args.get("q", "").strip()
-    items_query = Employee.query.filter_by(company_id=current_user.company_id)
-    if query_text:
-        items_query = items_query.filter(Employee.name.like(f"%{query_text}%"))
-    items = items_query.order_by(Employee.created_at.desc()).all()
-    teams_data = Team.query.filter_by(company_id=current_user.company_id).order_by(Team.name.asc()).all()
+    def load_employees():
+        items_stmt = EMPLOYEE_LIST_STMT.options(*eager_options(selectinload(Employee.teams)))
+        if query_text:
+            items_stmt = filter_employee_name(items_stmt, query_text)
+        rows = db.session.execute(items_stmt, {"company_id": current_user.company_id}).scalars().all()
+        return [
+            {
+                "id": e.id,
+                "name": e.name,
+                "daily_salary": e.daily_salary,
+                "teams": [{"name": t.name} for t in e.teams],
+            }
+            for e in rows
+        ]
+
+    items = cached_company_data("employees", current_user.company_id, load_employees, query_text)
+    teams_data = company_team_choices(current_user.company_id)
     return render_template("employees.html", items=items, teams=teams_data, query_text=query_text)
 
 
 @app.route("/employee/<int:employee_id>/detail")
 @login_required
+@admin_required("仅管理员可查看。")
 def employee_detail(employee_id):
     """员工详情：查看某月每日考勤明细、登记人及月汇总。"""
-    if not current_user.is_admin:
-        flash("仅管理员可查看。", "danger")
-        return redirect(url_for("dashboard"))
-
-    employee = Employee.query.get_or_404(employee_id)
-    if not ensure_company_scope(employee):
-        return redirect(url_for("employees"))
+    employee = scoped_get(Employee, employee_id)
 
-    year = int(request.args.get("year", date.today().year))
-    month = int(request.args.get("month", date.today().month))
+    year, month = request_year_month()
 
-    logs = (
-        Attendance.query.filter(
+    start, end = month_bounds(year, month)
+    # 团队名与登记人随明细一次 JOIN 取出，不再逐行加载 team / 查询 User
+    logs = db.session.execute(
+        select(Attendance.work_date, Team.name, Attendance.day_count, User.username)
+        .join(Team, Team.id == Attendance.team_id)
+        .outerjoin(User, User.id == Attendance.created_by)
+        .where(
             Attendance.company_id == current_user.company_id,
             Attendance.employee_id == employee.id,
-            extract("year", Attendance.work_date) == year,
-            extract("month", Attendance.work_date) == month,
+            Attendance.work_date >= start,
+            Attendance.work_date < end,
         )
         .order_by(Attendance.work_date.asc())
-        .all()
-    )
-
-    detail_rows = []
-    for item in logs:
-        operator = User.query.get(item.created_by)
-        detail_rows.append(
-            {
-                "work_date": item.work_date,
-                "team_name": item.team.name,
-                "day_count": item.day_count,
-                "operator": operator.username if operator else "未知",
-            }
-        )
+    ).all()
+
+    detail_rows = [
+        {
+            "work_date": work_date,
+            "team_name": team_name,
+            "day_count": day_count,
+            "operator": operator_name or "未知",
+        }
+        for work_date, team_name, day_count, operator_name in logs
+    ]
 
     days, advances_amt, gross, remain = calculate_month_stat(employee.id, year, month)
 
@@ -906,14 +1665,112 @@ def attendance_redirect():
     return redirect(url_for("teams"))
 
 
-@app.route("/advances", methods=["GET", "POST"])
+@app.route("/attendance/bulk", methods=["POST"])
 @login_required
-def advances():
+def attendance_bulk():
+    """批量录入考勤（JSON 数组：employee_id/team_id/work_date/day_count），已存在的记录跳过不覆盖。"""
     if not current_user.is_admin:
-        flash("仅管理员可操作。", "danger")
-        return redirect(url_for("dashboard"))
+        return jsonify({"error": "仅管理员可操作。"}), 403
 
-    employees_data = Employee.query.filter_by(company_id=current_user.company_id).all()
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, list) or not payload:
+        return jsonify({"error": "请提交非空的考勤记录数组。"}), 400
+
+    rows = []
+    errors = []
+    for idx, item in enumerate(payload, start=1):
+        try:
+            employee_id = int(item["employee_id"])
+            team_id = int(item["team_id"])
+            work_date = datetime.strptime(item["work_date"], "%Y-%m-%d").date()
+            day_count = float(item["day_count"])
+        except (TypeError, KeyError, ValueError):
+            errors.append(f"第 {idx} 条：格式错误")
+            continue
+        if work_date > date.today():
+            errors.append(f"第 {idx} 条：不能记录未来日期的考勤")
+            continue
+        if day_count not in (0, 0.5, 1):
+            errors.append(f"第 {idx} 条：考勤天数只能是 0 / 0.5 / 1")
+            continue
+        rows.append((idx, employee_id, team_id, work_date, day_count))
+
+    inserted = []
+    skipped = 0
+    if rows:
+        employee_ids = {r[1] for r in rows}
+        team_ids = {r[2] for r in rows}
+
+        # 员工必须属于本公司的该团队：一次查询同时完成公司范围与团队成员校验
+        memberships = set(
+            db.session.query(team_members.c.employee_id, team_members.c.team_id)
+            .join(Team, Team.id == team_members.c.team_id)
+            .filter(
+                Team.company_id == current_user.company_id,
+                team_members.c.team_id.in_(team_ids),
+                team_members.c.employee_id.in_(employee_ids),
+            )
+            .all()
+        )
+
+        # 一次取出涉及员工在日期区间内的已有考勤，用于去重与“每日不超过 1 天”校验
+        existing = (
+            db.session.query(Attendance.employee_id, Attendance.team_id, Attendance.work_date, Attendance.day_count)
+            .filter(
+                Attendance.employee_id.in_(employee_ids),
+                Attendance.work_date >= min(r[3] for r in rows),
+                Attendance.work_date <= max(r[3] for r in rows),
+            )
+            .all()
+        )
+        seen_keys = {(e, t, d) for e, t, d, _ in existing}
+        day_totals = {}
+        for e, _t, d, c in existing:
+            day_totals[(e, d)] = day_totals.get((e, d), 0.0) + c
+
+        for idx, employee_id, team_id, work_date, day_count in rows:
+            if (employee_id, team_id, work_date) in seen_keys:
+                skipped += 1
+                continue
+            if (employee_id, team_id) not in memberships:
+                errors.append(f"第 {idx} 条：员工不在该团队或无权访问")
+                continue
+            total = day_totals.get((employee_id, work_date), 0.0)
+            if total + day_count > 1.0:
+                errors.append(f"第 {idx} 条：超过1天（当天已记录 {total} 天）")
+                continue
+
+            seen_keys.add((employee_id, team_id, work_date))
+            day_totals[(employee_id, work_date)] = total + day_count
+            inserted.append(
+                {
+                    "company_id": current_user.company_id,
+                    "employee_id": employee_id,
+                    "team_id": team_id,
+                    "work_date": work_date,
+                    "day_count": day_count,
+                    "created_by": current_user.id,
+                    "created_at": datetime.utcnow(),
+                }
+            )
+
+    inserted_count = 0
+    if inserted:
+        # 上面的校验基于查询时的快照；写入语句自带去重与上限条件，被并发写入抢先的记录不写入
+        inserted_count = db.session.execute(ATTENDANCE_INSERT_SQL, inserted).rowcount
+        if inserted_count < len(inserted):
+            errors.append(f"{len(inserted) - inserted_count} 条记录在导入期间已被他人写入或当天超过1天，未写入")
+        if inserted_count:
+            log_action("bulk_attendance", f"批量导入考勤：新增 {inserted_count} 条，跳过 {skipped} 条")
+        db.session.commit()
+
+    return jsonify({"inserted": inserted_count, "skipped": skipped, "errors": errors})
+
+
+@app.route("/advances", methods=["GET", "POST"])
+@login_required
+@admin_required()
+def advances():
     if request.method == "POST":
         employee_id = int(request.form["employee_id"])
         amount = float(request.form["amount"])
@@ -924,10 +1781,7 @@ def advances():
             flash("不能记录未来日期的借支。", "danger")
             return redirect(url_for("advances"))
 
-        employee = Employee.query.get_or_404(employee_id)
-        if employee.company_id != current_user.company_id:
-            flash("数据越权。", "danger")
-            return redirect(url_for("advances"))
+        employee = scoped_get(Employee, employee_id)
 
         item = Advance(
             company_id=current_user.company_id,
@@ -943,78 +1797,73 @@ def advances():
         flash("借支记录已保存。", "success")
         return redirect(url_for("advances"))
 
-    items = (
-        Advance.query.filter_by(company_id=current_user.company_id)
-        .order_by(Advance.advance_date.desc())
-        .limit(100)
-        .all()
+    items, next_cursor = keyset_page(
+        Advance.query.options(*eager_options(selectinload(Advance.employee))).filter_by(
+            company_id=current_user.company_id
+        ),
+        Advance.advance_date,
+        100,
+        date.fromisoformat,
+    )
+    employees_data = company_employee_choices(current_user.company_id)
+    return render_template(
+        "advances.html",
+        employees=employees_data,
+        items=items,
+        next_cursor=next_cursor,
+        today=date.today(),
     )
-    return render_template("advances.html", employees=employees_data, items=items, today=date.today())
 
 
 @app.route("/payroll")
 @login_required
 def payroll():
-    year = int(request.args.get("year", date.today().year))
-    month = int(request.args.get("month", date.today().month))
+    year, month = request_year_month()
     scope = request.args.get("scope", "month")  # month / all
     employee_q = request.args.get("employee_q", "").strip()
 
-    result = []
-    employees_query = Employee.query.filter_by(company_id=current_user.company_id)
+    employees_stmt = PAYROLL_EMPLOYEES_STMT
     if employee_q:
-        employees_query = employees_query.filter(Employee.name.like(f"%{employee_q}%"))
-    employees_data = employees_query.all()
+        employees_stmt = filter_employee_name(employees_stmt, employee_q)
+    employees_data = db.session.execute(employees_stmt, {"company_id": current_user.company_id}).all()
 
     # 统计所有出现过的月份（考勤或借支）
-    month_keys = set()
     if scope == "all":
-        att_dates = db.session.query(Attendance.work_date).filter_by(company_id=current_user.company_id).all()
-        adv_dates = db.session.query(Advance.advance_date).filter_by(company_id=current_user.company_id).all()
-        for (d,) in att_dates:
-            month_keys.add((d.year, d.month))
-        for (d,) in adv_dates:
-            month_keys.add((d.year, d.month))
-        if not month_keys:
-            month_keys.add((year, month))
+        month_keys = company_data_months(current_user.company_id) or {(year, month)}
     else:
-        month_keys.add((year, month))
+        month_keys = {(year, month)}
 
     ordered_months = sorted(month_keys)
+    month_stats = calculate_month_stats_bulk(current_user.company_id, ordered_months)
 
-    for emp in employees_data:
-        row = {
-            "name": emp.name,
-            "daily_salary": emp.daily_salary,
-            "total_days": 0.0,
-            "total_advances": 0.0,
-            "total_gross": 0.0,
-            "total_remain": 0.0,
-            "month_days": {},
-        }
-        for y, m in ordered_months:
-            days, advances_amt, gross, remain = calculate_month_stat(emp.id, y, m)
-            row["month_days"][(y, m)] = days
-            row["total_days"] += days
-            row["total_advances"] += advances_amt
-            row["total_gross"] += gross
-            row["total_remain"] += remain
-
-        row["total_days"] = round(row["total_days"], 2)
-        row["total_advances"] = round(row["total_advances"], 2)
-        row["total_gross"] = round(row["total_gross"], 2)
-        row["total_remain"] = round(row["total_remain"], 2)
-        result.append(row)
+    result = []
+    # 与导出共用同一个逐行计算生成器，页面只负责把元组整理成模板需要的字典
+    month_count = len(ordered_months)
+    for name, daily_salary, *values in iter_payroll_export_rows(employees_data, ordered_months, month_stats):
+        total_days, total_advances, total_gross, total_remain = values[month_count:]
+        result.append(
+            {
+                "name": name,
+                "daily_salary": daily_salary,
+                "total_days": total_days,
+                "total_advances": total_advances,
+                "total_gross": total_gross,
+                "total_remain": total_remain,
+                "month_days": dict(zip(ordered_months, values[:month_count])),
+            }
+        )
 
     # 备注信息展示
     month_notes = []
     all_notes_matrix = []
     if scope == "month":
+        month_start, month_end = month_bounds(year, month)
         notes = (
-            AttendanceNote.query.filter(
+            AttendanceNote.query.options(*eager_options(selectinload(AttendanceNote.team)))
+            .filter(
                 AttendanceNote.company_id == current_user.company_id,
-                extract("year", AttendanceNote.note_date) == year,
-                extract("month", AttendanceNote.note_date) == month,
+                AttendanceNote.note_date >= month_start,
+                AttendanceNote.note_date < month_end,
             )
             .order_by(AttendanceNote.note_date.asc())
             .all()
@@ -1022,17 +1871,14 @@ def payroll():
         for n in notes:
             month_notes.append({"date": n.note_date, "team": n.team.name, "note": n.note})
     else:
-        notes = AttendanceNote.query.filter_by(company_id=current_user.company_id).all()
-        buckets = {}
-        for n in notes:
-            key = (n.note_date.year, n.note_date.month)
-            if key not in buckets:
-                buckets[key] = {"year": key[0], "month": key[1], "days": {d: "" for d in range(1, 32)}}
-            day = n.note_date.day
-            existing = buckets[key]["days"][day]
-            text = f"{n.team.name}:{n.note}" if n.note else f"{n.team.name}:（空备注）"
-            buckets[key]["days"][day] = (existing + "；" + text).strip("；") if existing else text
-        all_notes_matrix = [buckets[k] for k in sorted(buckets.keys())]
+        notes = (
+            AttendanceNote.query.options(*eager_options(selectinload(AttendanceNote.team)))
+            .filter_by(company_id=current_user.company_id)
+            .all()
+        )
+        all_notes_matrix = [
+            {"year": year, "month": month, "days": days} for year, month, days in build_note_matrix(notes)
+        ]
 
     return render_template(
         "payroll.html",
@@ -1047,128 +1893,173 @@ def payroll():
     )
 
 
-@app.route("/export")
-@login_required
-def export_excel():
-    if not current_user.is_owner:
-        flash("仅公司创建者可导出。", "danger")
-        return redirect(url_for("dashboard"))
-
-    year = int(request.args.get("year", date.today().year))
-    month = int(request.args.get("month", date.today().month))
-    scope = request.args.get("scope", "month")
-    employee_q = request.args.get("employee_q", "").strip()
-
-    employees_query = Employee.query.filter_by(company_id=current_user.company_id)
+def prepare_payroll_export(company_id: int, year: int, month: int, scope: str, employee_q: str):
+    """汇总导出所需的员工、月份与按月统计，返回 (表头, 月份列表, 行生成器)。"""
+    # 只取导出需要的列；行对象不受提交后过期影响，流式输出时不会逐行回查数据库
+    employees_stmt = PAYROLL_EMPLOYEES_STMT
     if employee_q:
-        employees_query = employees_query.filter(Employee.name.like(f"%{employee_q}%"))
-    employees_data = employees_query.all()
+        employees_stmt = filter_employee_name(employees_stmt, employee_q)
+    employees_data = db.session.execute(employees_stmt, {"company_id": company_id}).all()
 
     # 统计需导出的月份
-    month_keys = set()
     if scope == "all":
-        att_dates = db.session.query(Attendance.work_date).filter_by(company_id=current_user.company_id).all()
-        adv_dates = db.session.query(Advance.advance_date).filter_by(company_id=current_user.company_id).all()
-        for (d,) in att_dates:
-            month_keys.add((d.year, d.month))
-        for (d,) in adv_dates:
-            month_keys.add((d.year, d.month))
-        if not month_keys:
-            month_keys.add((year, month))
+        month_keys = company_data_months(company_id) or {(year, month)}
     else:
-        month_keys.add((year, month))
+        month_keys = {(year, month)}
 
     ordered_months = sorted(month_keys)
+    month_stats = calculate_month_stats_bulk(company_id, ordered_months)
 
-    rows = []
-    for emp in employees_data:
-        row = {
-            "员工姓名": emp.name,
-            "单日工资": emp.daily_salary,
-        }
-        total_days = 0.0
-        total_advances = 0.0
-        total_gross = 0.0
+    headers = ["员工姓名", "单日工资"]
+    headers += [f"{y}年{m}月考勤天数" for y, m in ordered_months]
+    headers += ["总考勤天数", "总借支", "总工资", "剩余工资"]
+    return headers, ordered_months, iter_payroll_export_rows(employees_data, ordered_months, month_stats)
 
-        for y, m in ordered_months:
-            days, advances_amt, gross, _remain = calculate_month_stat(emp.id, y, m)
-            ym_label = f"{y}年{m}月"
-            row[f"{ym_label}考勤天数"] = days
-            total_days += days
-            total_advances += advances_amt
-            total_gross += gross
 
-        row["总考勤天数"] = round(total_days, 2)
-        row["总借支"] = round(total_advances, 2)
-        row["总工资"] = round(total_gross, 2)
-        row["剩余工资"] = round(total_gross - total_advances, 2)
-        rows.append(row)
-
-    df = pd.DataFrame(rows)
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="工资统计")
-
-        # 备注信息同导出
-        if scope == "month":
-            note_rows = []
-            notes = (
-                AttendanceNote.query.filter(
-                    AttendanceNote.company_id == current_user.company_id,
-                    extract("year", AttendanceNote.note_date) == year,
-                    extract("month", AttendanceNote.note_date) == month,
-                )
-                .order_by(AttendanceNote.note_date.asc())
-                .all()
+@app.route("/export")
+@login_required
+@owner_required("仅公司创建者可导出。")
+def export_excel():
+    year, month = request_year_month()
+    scope = request.args.get("scope", "month")
+    employee_q = request.args.get("employee_q", "").strip()
+
+    headers, ordered_months, rows = prepare_payroll_export(current_user.company_id, year, month, scope, employee_q)
+    month_count = len(ordered_months)
+
+    # 写入临时文件而不是内存缓冲区，下载结束后再删除；
+    # constant_memory 模式下每写完一行即落盘，要求严格按行顺序写入
+    os.makedirs(app.config["EXPORT_DIR"], exist_ok=True)
+    cleanup_stale_exports()
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx", dir=app.config["EXPORT_DIR"])
+    tmp.close()
+    workbook = xlsxwriter.Workbook(tmp.name, {"constant_memory": True})
+    header_format = workbook.add_format({"bold": True, "border": 1})
+    money_format = workbook.add_format({"num_format": "#,##0.00"})
+    date_format = workbook.add_format({"num_format": "yyyy-mm-dd"})
+
+    money_columns = [1, month_count + 3, month_count + 4, month_count + 5]
+    write_excel_sheet(
+        workbook,
+        "工资统计",
+        headers,
+        rows,
+        header_format,
+        {col: money_format for col in money_columns},
+    )
+
+    # 备注信息同导出
+    if scope == "month":
+        month_start, month_end = month_bounds(year, month)
+        notes = (
+            AttendanceNote.query.options(*eager_options(selectinload(AttendanceNote.team)))
+            .filter(
+                AttendanceNote.company_id == current_user.company_id,
+                AttendanceNote.note_date >= month_start,
+                AttendanceNote.note_date < month_end,
             )
-            for n in notes:
-                note_rows.append({"日期": n.note_date, "团队": n.team.name, "备注": n.note})
-            pd.DataFrame(note_rows).to_excel(writer, index=False, sheet_name="考勤备注")
-        else:
-            notes = AttendanceNote.query.filter_by(company_id=current_user.company_id).all()
-            buckets = {}
-            for n in notes:
-                key = (n.note_date.year, n.note_date.month)
-                if key not in buckets:
-                    buckets[key] = {"年月": f"{key[0]}年{key[1]}月", **{str(d): "" for d in range(1, 32)}}
-                d = str(n.note_date.day)
-                text = f"{n.team.name}:{n.note}" if n.note else f"{n.team.name}:（空备注）"
-                buckets[key][d] = (buckets[key][d] + "；" + text).strip("；") if buckets[key][d] else text
-            pd.DataFrame([buckets[k] for k in sorted(buckets.keys())]).to_excel(writer, index=False, sheet_name="备注矩阵")
-    output.seek(0)
+            .order_by(AttendanceNote.note_date.asc())
+            .all()
+        )
+        write_excel_sheet(
+            workbook,
+            "考勤备注",
+            ["日期", "团队", "备注"],
+            ((n.note_date, n.team.name, n.note) for n in notes),
+            header_format,
+            {0: date_format},
+        )
+    else:
+        notes = (
+            AttendanceNote.query.options(*eager_options(selectinload(AttendanceNote.team)))
+            .filter_by(company_id=current_user.company_id)
+            .all()
+        )
+        write_excel_sheet(
+            workbook,
+            "备注矩阵",
+            ["年月"] + [str(d) for d in range(1, 32)],
+            ([f"{year}年{month}月"] + [days[d] for d in range(1, 32)] for year, month, days in build_note_matrix(notes)),
+            header_format,
+        )
+    workbook.close()
 
     log_action("export_excel", f"导出工资表：scope={scope}，关键字={employee_q or '全部'}，基准={year}-{month:02d}")
     db.session.commit()
 
     suffix = "全部月份" if scope == "all" else f"{year}_{month:02d}"
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f"工资统计_{suffix}.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    download_name = f"工资统计_{suffix}.xlsx"
+    mimetype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    accel_prefix = app.config["EXPORT_ACCEL_PREFIX"]
+    if accel_prefix:
+        # 由 nginx 以 sendfile 零拷贝发送文件，Python 不再读取文件内容；文件由 cleanup_stale_exports 定期清理
+        response = Response(mimetype=mimetype)
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename=export.xlsx; filename*=UTF-8''{quote(download_name)}"
+        )
+        response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + os.path.basename(tmp.name)
+        return response
+
+    response = send_file(tmp.name, as_attachment=True, download_name=download_name, mimetype=mimetype)
+    response.call_on_close(lambda: os.remove(tmp.name))
+    return response
+
+
+@app.route("/export.csv")
+@login_required
+@owner_required("仅公司创建者可导出。")
+def export_csv():
+    year, month = request_year_month()
+    scope = request.args.get("scope", "month")
+    employee_q = request.args.get("employee_q", "").strip()
+
+    headers, _ordered_months, rows = prepare_payroll_export(current_user.company_id, year, month, scope, employee_q)
+
+    log_action("export_csv", f"导出工资表CSV：scope={scope}，关键字={employee_q or '全部'}，基准={year}-{month:02d}")
+    db.session.commit()
+
+    def generate():
+        # 逐行写出，内存占用与员工数量无关；带 BOM 以便 Excel 正确识别中文
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write("\ufeff")
+        writer.writerow(headers)
+        yield buffer.getvalue()
+        for row in rows:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(row)
+            yield buffer.getvalue()
+
+    suffix = "全部月份" if scope == "all" else f"{year}_{month:02d}"
+    download_name = f"工资统计_{suffix}.csv"
+    response = Response(stream_with_context(generate()), mimetype="text/csv")
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename=payroll.csv; filename*=UTF-8''{quote(download_name)}"
     )
+    return response
 
 
 @app.route("/logs")
 @login_required
+@owner_required("仅公司创建者可查看日志。")
 def logs():
-    if not current_user.is_owner:
-        flash("仅公司创建者可查看日志。", "danger")
-        return redirect(url_for("dashboard"))
-
-    items = (
-        AuditLog.query.filter_by(company_id=current_user.company_id)
-        .order_by(AuditLog.created_at.desc())
-        .limit(200)
-        .all()
+    items, next_cursor = keyset_page(
+        AuditLog.query.options(*eager_options(selectinload(AuditLog.operator))).filter_by(
+            company_id=current_user.company_id
+        ),
+        AuditLog.created_at,
+        200,
+        datetime.fromisoformat,
     )
-    return render_template("logs.html", items=items)
+    return render_template("logs.html", items=items, next_cursor=next_cursor)
 
 
 if __name__ == "__main__":
     os.makedirs(os.path.join(base_dir, "data"), exist_ok=True)
     with app.app_context():
-        db.create_all()
+        init_db()
 
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "5000"))
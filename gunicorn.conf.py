@@ -0,0 +1,9 @@
+# gunicorn 启动时会自动读取工作目录下的本文件（命令行参数优先）
+
+
+def post_fork(server, worker):
+    """worker 进程 fork 后丢弃从 master 继承的连接池（使用 --preload 时 master 已建立过连接）。"""
+    from app import app, db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -11,6 +11,7 @@ APP_DIR="${APP_DIR:-/opt/kaoqingC}"
 DB_FILE="${DB_FILE:-$APP_DIR/data/attendance.db}"
 BACKUP_DIR="${BACKUP_DIR:-$APP_DIR/backup}"
 RETENTION_DAYS="${RETENTION_DAYS:-14}"
+PYTHON_BIN="${PYTHON_BIN:-python3}"
 
 if [[ ! -f "$DB_FILE" ]]; then
   echo "错误：数据库文件不存在：$DB_FILE" >&2
@@ -19,7 +20,19 @@ fi
 
 mkdir -p "$BACKUP_DIR"
 BACKUP_FILE="$BACKUP_DIR/attendance_$(date +%F_%H-%M-%S).db"
-cp "$DB_FILE" "$BACKUP_FILE"
+# 数据库启用了 WAL，最近的提交可能还在 -wal 文件里，直接 cp 主文件会丢数据；
+# 这里使用 SQLite 在线备份 API 得到一致的快照
+"$PYTHON_BIN" - "$DB_FILE" "$BACKUP_FILE" <<'PY'
+import sqlite3
+import sys
+
+src = sqlite3.connect(sys.argv[1])
+dst = sqlite3.connect(sys.argv[2])
+with dst:
+    src.backup(dst)
+dst.close()
+src.close()
+PY
 
 # 删除超过保留天数的旧备份
 find "$BACKUP_DIR" -type f -name 'attendance_*.db' -mtime +"$RETENTION_DAYS" -delete
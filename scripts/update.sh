@@ -3,18 +3,34 @@ set -euo pipefail
 
 # =========================
 # 企业考勤系统一键更新脚本
-# 功能：备份数据库 -> 更新代码 -> 安装依赖 -> 语法检查 -> 重启服务 -> 健康检查
+# 功能：备份数据库 -> 更新代码 -> 安装依赖 -> 语法检查与数据库结构同步 -> 重启服务 -> 健康检查
 # =========================
 
 APP_DIR="/opt/kaoqingC"
 VENV_PY="$APP_DIR/.venv/bin/python"
 VENV_PIP="$APP_DIR/.venv/bin/pip"
 SERVICE_NAME="kaoqing"
+ENV_FILE="$APP_DIR/.env"
 DB_FILE="$APP_DIR/data/attendance.db"
 BACKUP_DIR="$APP_DIR/backup"
 DEFAULT_BRANCH="work"
 BRANCH="${1:-$DEFAULT_BRANCH}"
 
+# 数据库启用了 WAL，直接 cp 主文件可能丢失最近的提交，统一用 SQLite 在线备份 API
+sqlite_backup() {
+  "$VENV_PY" - "$1" "$2" <<'PY'
+import sqlite3
+import sys
+
+src = sqlite3.connect(sys.argv[1])
+dst = sqlite3.connect(sys.argv[2])
+with dst:
+    src.backup(dst)
+dst.close()
+src.close()
+PY
+}
+
 log() {
   echo "[$(date '+%F %T')] $*"
 }
@@ -46,7 +62,7 @@ main() {
   log "1/7 备份数据库"
   mkdir -p "$BACKUP_DIR"
   if [[ -f "$DB_FILE" ]]; then
-    cp "$DB_FILE" "$BACKUP_DIR/attendance_$(date +%F_%H-%M-%S).db"
+    sqlite_backup "$DB_FILE" "$BACKUP_DIR/attendance_$(date +%F_%H-%M-%S).db"
     log "数据库备份完成：$BACKUP_DIR"
   else
     log "未找到数据库文件（首次部署可忽略）：$DB_FILE"
@@ -66,8 +82,19 @@ main() {
   log "3/7 安装/同步依赖"
   "$VENV_PIP" install -r requirements.txt
 
-  log "4/7 语法检查"
+  log "4/7 语法检查与数据库结构同步"
   "$VENV_PY" -m compileall app.py templates
+  (
+    if [[ -f "$ENV_FILE" ]]; then
+      set -a
+      source "$ENV_FILE"
+      set +a
+    fi
+    "$VENV_PY" -c 'from app import app, init_db
+with app.app_context():
+    init_db()'
+  )
+  log "数据库表与索引已同步"
 
   log "5/7 重启应用服务"
   systemctl restart "$SERVICE_NAME"
@@ -26,6 +26,21 @@ HEALTH_WAIT_SEC="${HEALTH_WAIT_SEC:-2}"
 APP_HOST="127.0.0.1"
 APP_PORT="5000"
 
+# 数据库启用了 WAL，直接 cp 主文件可能丢失最近的提交，统一用 SQLite 在线备份 API
+sqlite_backup() {
+  "$VENV_PY" - "$1" "$2" <<'PY'
+import sqlite3
+import sys
+
+src = sqlite3.connect(sys.argv[1])
+dst = sqlite3.connect(sys.argv[2])
+with dst:
+    src.backup(dst)
+dst.close()
+src.close()
+PY
+}
+
 log() {
   echo "[$(date '+%F %T')] $*"
 }
@@ -68,11 +83,11 @@ backup_db() {
 
   case "$BACKUP_MODE" in
     rotate)
-      cp "$DB_FILE" "$BACKUP_DIR/attendance_$(date +%F_%H-%M-%S).db"
+      sqlite_backup "$DB_FILE" "$BACKUP_DIR/attendance_$(date +%F_%H-%M-%S).db"
       log "数据库备份完成（历史保留）：$BACKUP_DIR"
       ;;
     overwrite)
-      cp "$DB_FILE" "$BACKUP_DIR/attendance_latest.db"
+      sqlite_backup "$DB_FILE" "$BACKUP_DIR/attendance_latest.db"
       log "数据库备份完成（覆盖模式）：$BACKUP_DIR/attendance_latest.db"
       ;;
     *)
@@ -148,8 +163,19 @@ main() {
   log "3/7 安装依赖"
   "$VENV_PIP" install -r requirements.txt
 
-  log "4/7 语法检查"
+  log "4/7 语法检查与数据库结构同步"
   "$VENV_PY" -m compileall app.py templates
+  (
+    if [[ -f "$ENV_FILE" ]]; then
+      set -a
+      source "$ENV_FILE"
+      set +a
+    fi
+    "$VENV_PY" -c 'from app import app, init_db
+with app.app_context():
+    init_db()'
+  )
+  log "数据库表与索引已同步"
 
   log "5/7 重启服务"
   systemctl restart "$SERVICE_NAME"